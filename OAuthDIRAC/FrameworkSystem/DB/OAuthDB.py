@@ -6,7 +6,7 @@ import json
 import pprint
 
 from ast import literal_eval
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from DIRAC import gConfig, S_OK, S_ERROR, gLogger
 from DIRAC.Core.Base.DB import DB
@@ -21,6 +21,9 @@ __RCSID__ = "$Id$"
 
 gCSAPI = CSAPI()
 
+# Reserved sessions are stored with this prefix in front of the source session id
+RESERVED_SESSION_RE = re.compile('^reserved_.*')
+
 
 class OAuthDB(DB):
   """ OAuthDB class is a front-end to the OAuth Database
@@ -36,6 +39,8 @@ class OAuthDB(DB):
                                        'RefreshToken': 'VARCHAR(1000)',
                                        'LastAccess': 'DATETIME'},
                             'PrimaryKey': 'Session',
+                            'Indexes': {'ID_Provider': ['ID', 'Provider'], 'LastAccess': ['LastAccess'],
+                                        'ExpiresIn': ['ExpiresIn']},
                             'Engine': 'InnoDB'}}
 
   def __init__(self):
@@ -77,36 +82,45 @@ class OAuthDB(DB):
         :return: S_OK()/S_ERROR()
     """
     IdPSessionsInfo = {}
-    result = self._query("SELECT DISTINCT ID, Provider, Session FROM `Sessions`")
+    condDict = {}
+    if idPs:
+      condDict['Provider'] = idPs
+    if IDs:
+      condDict['ID'] = IDs
+    result = self.getFields('Sessions', outFields=['ID', 'Provider', 'Session'], condDict=condDict)
     if not result['OK']:
       return result
+    providers = {}
+    zombieSessions = []
     for ID, idP, session in result['Value']:
-      if (idPs and idP not in idPs) or (IDs and ID not in IDs):
-        continue
       if ID not in IdPSessionsInfo:
         IdPSessionsInfo[ID] = {'Providers': []}
       if idP not in IdPSessionsInfo[ID]:
-        result = IdProviderFactory().getIdProvider(idP)
-        if not result['OK']:
-          return result
-        __provObj = result['Value']
-        result = __provObj.getUserProfile(session)
-        if not result['OK']:
+        if idP not in providers:
+          result = IdProviderFactory().getIdProvider(idP)
+          if not result['OK']:
+            return result
+          providers[idP] = result['Value']
+        result = providers[idP].getUserProfile(session)
+        if not result['OK'] and not result.get('Transient'):
           self.log.error(result['Message'])
-          kill = self.killSession(session)
-          self.log.warn('Cannot get user profile for %s session, removed.' % session, kill.get('Value') or kill.get('Message'))
+          self.log.warn('Cannot get user profile for %s session, will be removed.' % session)
+          zombieSessions.append(session)
           continue
-        userProfile = result['Value']
+        if not result['OK']:
+          # Identity provider is not available, keep the session without profile information
+          self.log.warn('Cannot get user profile for %s session:' % session, result['Message'])
+        userProfile = result.get('Value') or {}
         result = self.getTokensBySession(session)
         if not result['OK']:
           return result
         tokens = result['Value']
         if not tokens:
-          result = self.killSession(session)
-          self.log.warn('Not found tokens for %s session, removed.' % session, result.get('Value') or result.get('Message'))
+          self.log.warn('Not found tokens for %s session, will be removed.' % session)
+          zombieSessions.append(session)
           continue
         IdPSessionsInfo[ID][idP] = {session: tokens}
-        IdPSessionsInfo[ID]['Providers'] = list(set(IdPSessionsInfo[ID]['Providers'] + [idP]))
+        IdPSessionsInfo[ID]['Providers'].append(idP)
         # Fill user profile
         for key, value in userProfile.items():
           if key in IdPSessionsInfo[ID]:
@@ -118,11 +132,14 @@ class OAuthDB(DB):
           return result
         tokens = result['Value']
         if not tokens:
-          result = self.killSession(session)
-          self.log.warn('Not found tokens for %s session, removed.' % session, result.get('Value') or result.get('Message'))
+          self.log.warn('Not found tokens for %s session, will be removed.' % session)
+          zombieSessions.append(session)
           continue
         IdPSessionsInfo[ID][idP][session] = tokens
-      
+
+    if zombieSessions:
+      result = self.killSessions(zombieSessions)
+      self.log.warn('%s sessions removed:' % len(zombieSessions), result.get('Value') or result.get('Message'))
     return S_OK(IdPSessionsInfo)
 
   def getAuthorization(self, providerName, session=None):
@@ -217,15 +234,15 @@ class OAuthDB(DB):
     __mail = {}
     result = getUsernameForID(parseDict['UsrOptns']['ID'])
     if not result['OK']:
-      groups = []
-      for dn in parseDict['UsrOptns']['DNs'].keys():
+      groups = set()
+      for dn in parseDict['UsrOptns']['DNs']:
         result = getGroupsForDN(dn)
         if not result['OK']:
           return result
-        groups = list(set(groups + result['Value']))
+        groups.update(result['Value'])
       if groups:
         status = 'authed and notify'
-        comment = 'Administrators was notified about you. Found new groups %s' % groups
+        comment = 'Administrators was notified about you. Found new groups %s' % list(groups)
         __mail['subject'] = "[OAuthManager] User %s to be added." % parseDict['username']
         __mail['body'] = 'User %s was authenticated by ' % parseDict['UsrOptns']['FullName']
         __mail['body'] += providerName
@@ -251,7 +268,7 @@ class OAuthDB(DB):
       return S_ERROR('No refresh token found in response.')
 
     # If current session is session to reserve
-    if re.match('^reserved_.*', session):
+    if RESERVED_SESSION_RE.match(session):
       # Update status in source session
       result = self.updateSession({'ID': parseDict['UsrOptns']['ID'], 'Status': status, 'Comment': comment},
                                   session=session.replace('reserved_', ''))
@@ -267,12 +284,12 @@ class OAuthDB(DB):
       return S_OK((parseDict, status, comment, __mail))
 
     # If current session is not reserve, search reserved session
-    result = self._query('SELECT Session FROM `Sessions` WHERE ID="%s" AND Provider="%s"' % (parseDict['UsrOptns']['ID'],
-                                                                                             providerName))
+    result = self.getFields('Sessions', outFields=['Session'], condDict={'ID': parseDict['UsrOptns']['ID'],
+                                                                         'Provider': providerName})
     if not result['OK']:
       return result
 
-    if not any(re.match('^reserved_.*', s[0]) for s in result['Value']):
+    if not any(RESERVED_SESSION_RE.match(s[0]) for s in result['Value']):
       # If no found reserved session 
       if status == 'authed':
         # If current session will use, need to redirect to create reserved session
@@ -296,7 +313,7 @@ class OAuthDB(DB):
         'Comment': '',
         'Session': 'reserved_%s' % session,
         'Provider': providerName,
-        'ExpiresIn': parseDict['Tokens']['ExpiresIn'],
+        'ExpiresIn': datetime.utcnow() + timedelta(seconds=parseDict['Tokens']['ExpiresIn']),
         'TokenType': parseDict['Tokens']['TokenType'],
         'AccessToken': parseDict['Tokens']['AccessToken'],
         'RefreshToken': parseDict['Tokens']['RefreshToken'],
@@ -327,7 +344,7 @@ class OAuthDB(DB):
 
         :return: S_OK(basestring)/S_ERROR()
     """
-    __conn = 'Status = "prepared" and TIMESTAMPDIFF(SECOND,LastAccess,UTC_TIMESTAMP()) < 300'
+    __conn = 'Status = "prepared" AND LastAccess > SUBDATE(UTC_TIMESTAMP(), INTERVAL 300 SECOND)'
     result = self.__getFields(['Comment'], conn=__conn, session=session)
     if not result['OK']:
       return result
@@ -348,6 +365,34 @@ class OAuthDB(DB):
     """
     return self.__getFields(["AccessToken", "ExpiresIn", "RefreshToken", "TokenType"], session=session)
   
+  def getFreshTokensBySession(self, session, timeLeft=600):
+    """ Get tokens dict by session, refresh tokens if access token will expire soon
+
+        :param basestring session: session number
+        :param int timeLeft: time in a seconds that access token must be valid
+
+        :return: S_OK(dict)/S_ERROR() -- dictionary contain tokens, "ExpiresIn" is a datetime
+    """
+    result = self.__getFields(["AccessToken", "ExpiresIn", "RefreshToken", "TokenType", "Provider"], session=session)
+    if not result['OK']:
+      return result
+    tokens = result['Value']
+    provider = tokens.pop('Provider')
+    if tokens['ExpiresIn'] and tokens['ExpiresIn'] - datetime.utcnow() > timedelta(seconds=timeLeft):
+      return S_OK(tokens)
+    result = IdProviderFactory().getIdProvider(provider)
+    if not result['OK']:
+      return result
+    result = self.__refreshTokens(session, result['Value'], tokens)
+    if not result['OK']:
+      return result
+    tokens = result['Value']
+    # Session is in use
+    result = self.updateSession(session=session)
+    if not result['OK']:
+      return result
+    return S_OK(tokens)
+
   def getStatusBySession(self, session):
     """ Get status dictionary by session id
 
@@ -373,19 +418,78 @@ class OAuthDB(DB):
         providerObj = result['Value']
         result = providerObj.fetch(sessions[i])
 
+  def fetchExpiringSessions(self, timeLeft=600, activeTime=3600):
+    """ Refresh tokens of the sessions in use, that access token will expire soon.
+        Last access time of the sessions is not changed, so unused sessions still become zombies
+
+        :param int timeLeft: time in a seconds before access token expiration
+        :param int activeTime: time in a seconds after last access while session is in use
+
+        :return: S_OK(int)/S_ERROR()
+    """
+    __conn = 'RefreshToken IS NOT NULL AND ExpiresIn < ADDDATE(UTC_TIMESTAMP(), INTERVAL %d SECOND)' % timeLeft
+    __conn += ' AND LastAccess > SUBDATE(UTC_TIMESTAMP(), INTERVAL %d SECOND)' % activeTime
+    result = self.__getFields(['Session', 'Provider', 'AccessToken', 'ExpiresIn', 'RefreshToken', 'TokenType'],
+                              conn=__conn)
+    if not result['OK']:
+      return result
+    sessions = result['Value']
+    self.log.info('Found %s sessions with expiring access token' % len(sessions))
+    providers = {}
+    for tokens in sessions:
+      session = tokens.pop('Session')
+      provider = tokens.pop('Provider')
+      if provider not in providers:
+        result = IdProviderFactory().getIdProvider(provider)
+        if not result['OK']:
+          self.log.error(provider, result['Message'])
+        providers[provider] = result.get('Value')
+      if providers[provider]:
+        result = self.__refreshTokens(session, providers[provider], tokens, activeTime)
+        if not result['OK']:
+          # Sessions that failed because of provider unavailability are kept to refresh them in the next run
+          self.log.warn('Cannot refresh %s session%s:' % (session, ', keep it' if result.get('Transient') else ''),
+                        result['Message'])
+    return S_OK(len(sessions))
+
+  def __refreshTokens(self, session, provider, tokens, defaultLifetime=0):
+    """ Refresh tokens of the session and store them, last access time of the session is not changed.
+        Session is removed if identity provider rejects its refresh token
+
+        :param basestring session: session number
+        :param object provider: identity provider object
+        :param dict tokens: current tokens of the session
+        :param int defaultLifetime: time in a seconds to consider access token valid,
+               if identity provider did not report it
+
+        :return: S_OK(dict)/S_ERROR() -- dictionary contain fresh tokens, "ExpiresIn" is a datetime
+    """
+    result = provider.refreshTokens(tokens)
+    if not result['OK']:
+      if result.get('Transient'):
+        return result
+      kill = self.killSession(session)
+      return result if kill['OK'] else kill
+    tokens = result['Value']
+    tokens['ExpiresIn'] = datetime.utcnow() + timedelta(seconds=tokens['ExpiresIn'] or defaultLifetime)
+    result = self.updateFields('Sessions', updateDict=tokens, condDict={'Session': session})
+    if not result['OK']:
+      return result
+    return S_OK(tokens)
+
   def cleanZombieSessions(self):
     """ Kill sessions with old states
     
         :return: S_OK(int)/S_ERROR()
     """
-    result = self.__getFields(['Session'], conn='TIMESTAMPDIFF(SECOND,LastAccess,UTC_TIMESTAMP()) > 43200')
+    result = self.__getFields(['Session'], conn='LastAccess < SUBDATE(UTC_TIMESTAMP(), INTERVAL 43200 SECOND)')
     if not result['OK']:
       return result
     sessions = result['Value']
     self.log.info('Found %s old sessions for cleaning' % len(sessions))
     for i in range(0, len(sessions)):
       # If its reserved session
-      if re.match('^reserved_.*', sessions[i]['Session']):
+      if RESERVED_SESSION_RE.match(sessions[i]['Session']):
         continue
       if sessions[i].get('Session'):
         result = self.logOutSession(sessions[i]['Session'])
@@ -401,6 +505,15 @@ class OAuthDB(DB):
     """
     return self.deleteEntries('Sessions', condDict={'Session': session})
 
+  def killSessions(self, sessions):
+    """ Remove sessions with one query
+
+        :param list sessions: session ids
+
+        :return: S_OK()/S_ERROR()
+    """
+    return self.deleteEntries('Sessions', condDict={'Session': sessions})
+
   def logOutSession(self, session):
     """ Remove session
     
@@ -438,12 +551,9 @@ class OAuthDB(DB):
     fieldsToUpdate = fieldsToUpdate or {}
     fieldsToUpdate['LastAccess'] = 'UTC_TIMESTAMP()'
     # Convert seconds to datetime
-    if 'ExpiresIn' in fieldsToUpdate and isinstance(fieldsToUpdate['ExpiresIn'], int):
+    if 'ExpiresIn' in fieldsToUpdate and isinstance(fieldsToUpdate['ExpiresIn'], (int, long)):
       self.log.debug(session or '', 'session, convert access token live time %s seconds to date.' % fieldsToUpdate['ExpiresIn'])
-      result = self._query("SELECT ADDDATE(UTC_TIMESTAMP(), INTERVAL %s SECOND)" % fieldsToUpdate['ExpiresIn'])
-      if not result['OK']:
-        return result
-      fieldsToUpdate['ExpiresIn'] = result['Value'][0][0] if result['Value'] else 'UTC_TIMESTAMP()'
+      fieldsToUpdate['ExpiresIn'] = datetime.utcnow() + timedelta(seconds=fieldsToUpdate['ExpiresIn'])
     return self.updateFields('Sessions', updateDict=fieldsToUpdate, condDict=condDict, conn=conn)
   
   def __getFields(self, fields=None, conn=None, timeStamp=False, session=None, **kwargs):
@@ -482,4 +592,4 @@ class OAuthDB(DB):
         resList.append(d)
     if not resList and session:
       return S_ERROR('No %s session found.' % session)
-    return S_OK(resList[0] if session else restList)
+    return S_OK(resList[0] if session else resList)
@@ -46,6 +46,7 @@ class OAuthManagerHandler(RequestHandler):
     """ Handler initialization
     """
     gThreadScheduler.addPeriodicTask(3600, gOAuthDB.cleanZombieSessions)
+    gThreadScheduler.addPeriodicTask(300, gOAuthDB.fetchExpiringSessions)
     gThreadScheduler.addPeriodicTask(3600 * 24, cls.__refreshIdPsIDsCache)
     return cls.__refreshIdPsIDsCache()
 
@@ -174,6 +175,18 @@ class OAuthManagerHandler(RequestHandler):
     """
     return gOAuthDB.getTokensBySession(session)
 
+  types_getFreshSessionTokens = [basestring, (int, long)]
+
+  def export_getFreshSessionTokens(self, session, timeLeft):
+    """ Get tokens by session number, refresh them if access token will expire soon
+
+        :param basestring session: session number
+        :param int timeLeft: time in a seconds that access token must be valid
+
+        :return: S_OK(dict)/S_ERROR()
+    """
+    return gOAuthDB.getFreshTokensBySession(session, timeLeft)
+
   @staticmethod
   def __cleanOAuthDB():
     """ Check OAuthDB for zombie sessions and clean
@@ -1,8 +1,10 @@
 """ Handler to serve the DIRAC configuration data
 """
 import re
+import datetime
 
 from tornado import web, gen
+from tornado.locks import Event
 from tornado.template import Template
 
 from DIRAC import S_OK, S_ERROR, gConfig, gLogger
@@ -21,6 +23,12 @@ class AuthHandler(WebHandler):
   AUTH_PROPS = "all"
   LOCATION = "/"
 
+  # Session statuses that a status request with "wait" option will wait to change
+  WAIT_STATUSES = ['prepared', 'in progress', 'finishing', 'redirect']
+  MAX_WAIT = 60
+
+  __sessionEvents = {}
+
   def initialize(self):
     super(AuthHandler, self).initialize()
     self.args = {}
@@ -40,8 +48,10 @@ class AuthHandler(WebHandler):
               * email - email to get authentcation URL(optional)
 
           GET /auth/<session> -- will redirect to authentication endpoint
-          GET /auth/<session>/status -- retrieve session with status and describe
+          GET /auth/<session>/status?<options> -- retrieve session with status and describe
             * session - session number
+            * options:
+              * wait - seconds to wait for the session status change, max 60(optional)
 
           GET /auth/redirect?<options> -- redirect endpoint to catch authentication responce
             * options - responce options
@@ -92,6 +102,7 @@ class AuthHandler(WebHandler):
         raise WErr(404, '"state" argument is empty.')
       self.log.info(self.args['state'], 'session, parsing authorization response %s' % self.args)
       result = yield self.threadTask(gSessionManager.parseAuthResponse, self.args, self.args['state'])
+      self.__notifySession(self.args['state'])
       if not result['OK']:
         raise WErr(500, result['Message'])
       comment = result['Value']['Comment']
@@ -122,9 +133,31 @@ class AuthHandler(WebHandler):
       elif optns[-1] == 'status':
         # Get session authentication status
         self.log.info(session, 'session, get status of authorization.')
-        result = yield self.threadTask(gSessionManager.getSessionStatus, session)
-        if not result['OK']:
-          raise WErr(500, result['Message'])
+        wait = self.get_argument('wait', '')
+        waiter = None
+        if re.match('[0-9]+$', wait):
+          # Register before reading the status to not miss the response that come in the meantime
+          waiter = self.__sessionEvents.setdefault(session, {'Event': Event(), 'Waiters': 0})
+          waiter['Waiters'] += 1
+        try:
+          result = yield self.threadTask(gSessionManager.getSessionStatus, session)
+          if not result['OK']:
+            raise WErr(500, result['Message'])
+          if waiter and result['Value']['Status'] in self.WAIT_STATUSES:
+            # Hold the request until the authorization response come or the time is up
+            try:
+              yield waiter['Event'].wait(timeout=datetime.timedelta(seconds=min(int(wait), self.MAX_WAIT)))
+            except gen.TimeoutError:
+              pass
+            result = yield self.threadTask(gSessionManager.getSessionStatus, session)
+            if not result['OK']:
+              raise WErr(500, result['Message'])
+        finally:
+          if waiter:
+            waiter['Waiters'] -= 1
+            # Forget the event of the session that nobody waits anymore
+            if not waiter['Waiters'] and self.__sessionEvents.get(session) is waiter:
+              del self.__sessionEvents[session]
         self.set_cookie("TypeAuth", result['Value']['Provider'])
         self.set_cookie(result['Value']['Provider'], session)
         self.finishJEncode(result['Value'])
@@ -134,3 +167,13 @@ class AuthHandler(WebHandler):
 
     else:
       raise WErr(404, "Wrone way")
+
+  def __notifySession(self, session):
+    """ Wake up status requests that wait for the session
+
+        :param basestring session: session number
+    """
+    for s in set([session, session.replace('reserved_', '')]):
+      waiter = self.__sessionEvents.pop(s, None)
+      if waiter:
+        waiter['Event'].set()
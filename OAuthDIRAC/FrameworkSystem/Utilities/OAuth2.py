@@ -6,8 +6,10 @@ import re
 import random
 import string
 import pprint
+import urllib
 
 from requests import Session, exceptions
+from requests.adapters import HTTPAdapter
 
 from DIRAC import gConfig, gLogger, S_OK, S_ERROR
 from DIRAC.ConfigurationSystem.Client.Utilities import getAuthAPI
@@ -33,6 +35,8 @@ class OAuth2(Session):
     super(OAuth2, self).__init__()
     self.exceptions = exceptions
     self.verify=False
+    # Keep connections to the provider alive between requests of the concurrent threads
+    self.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
 
     __optns = {}
     self.parameters = {}
@@ -106,19 +110,21 @@ class OAuth2(Session):
     """
     state = state or self.createState()
     self.log.info(state, 'session, generate URL for authetication.')
-    url = kwargs.get('authorization_endpoint') or self.parameters['authorization_endpoint']
+    url = kwargs.pop('authorization_endpoint', None) or self.parameters['authorization_endpoint']
     if not url:
       return S_ERROR('No found authorization endpoint.')
-    url += '?state=%s&response_type=code&client_id=%s&access_type=offline' % (state, self.parameters['client_id'])
+    kwargs['state'] = state
+    kwargs['response_type'] = 'code'
+    kwargs['client_id'] = self.parameters['client_id']
+    kwargs['access_type'] = 'offline'
     if self.parameters['prompt']:
-      url += '&prompt=%s' % self.parameters['prompt']
+      kwargs['prompt'] = self.parameters['prompt']
     kwargs['redirect_uri'] = kwargs.get('redirect_uri') or self.parameters['redirect_uri']
     kwargs['scope'] = kwargs.get('scope') or self.parameters['scope'] or self.parameters['scopes_supported']
-    for key in kwargs:
-      if isinstance(kwargs[key],list):
-        kwargs[key] = '+'.join(kwargs[key])
-      url += '&%s=%s' % (key, kwargs[key])
-    return S_OK({'URL': url, 'Session': state})
+    for key, value in kwargs.items():
+      if isinstance(value, list):
+        kwargs[key] = ' '.join(value)
+    return S_OK({'URL': '%s?%s' % (url, urllib.urlencode(kwargs)), 'Session': state})
 
   def parseAuthResponse(self, code):
     """ Collecting information about user
@@ -161,13 +167,17 @@ class OAuth2(Session):
     """
     if not self.parameters['userinfo_endpoint']:
       return S_ERROR('Not found userinfo endpoint.')
+    r = None
     try:
       r = self.request('GET', self.parameters['userinfo_endpoint'],
                        headers={'Authorization': 'Bearer ' + accessToken})
       r.raise_for_status()
       return S_OK(r.json())
     except (self.exceptions.RequestException, ValueError) as e:
-      return S_ERROR("%s: %s" % (e.message, r.text))
+      result = S_ERROR("%s: %s" % (e.message, r.text if r is not None else ''))
+      # Provider is unreachable or broken, that is not a reason to think that tokens are invalid
+      result['Transient'] = r is None or r.status_code >= 500
+      return result
 
   def revokeToken(self, accessToken=None, refreshToken=None):
     """ Revoke token
@@ -184,9 +194,9 @@ class OAuth2(Session):
     for key, value in [('access_token', accessToken), ('refresh_token', refreshToken)]:
       if not value:
         continue
-      self.params = {'token': key, 'token_type_hint': value}
       try:
-        self.request('POST', self.parameters['token_endpoint']).raise_for_status()
+        self.request('POST', self.parameters['token_endpoint'],
+                     params={'token': value, 'token_type_hint': key}).raise_for_status()
       except self.exceptions.RequestException as e:
         return S_ERROR("%s: %s" % (e.message, e.r.text))
     return S_OK()
@@ -201,27 +211,31 @@ class OAuth2(Session):
     """
     if not self.parameters['token_endpoint']:
       return S_ERROR('Not found token_endpoint for %s provider' % self.parameters['name'])
-    self.params = {'access_type': 'offline'}
+    params = {'access_type': 'offline'}
     for arg in ['client_id', 'client_secret', 'prompt']:
-      self.params[arg] = self.parameters[arg]
+      params[arg] = self.parameters[arg]
     if code:
       if not self.parameters['redirect_uri']:
         return S_ERROR('Not found redirect_uri for %s provider' % self.parameters['name'])
-      self.params['code'] = code
-      self.params['grant_type'] = 'authorization_code'
-      self.params['redirect_uri'] = self.parameters['redirect_uri']
+      params['code'] = code
+      params['grant_type'] = 'authorization_code'
+      params['redirect_uri'] = self.parameters['redirect_uri']
     elif refreshToken:
-      self.params['grant_type'] = 'refresh_token'
-      self.params['refresh_token'] = refreshToken
+      params['grant_type'] = 'refresh_token'
+      params['refresh_token'] = refreshToken
     else:
       return S_ERROR('No authorization code or refresh token found.')
+    r = None
     try:
-      r = self.request('POST', self.parameters['token_endpoint'],
+      r = self.request('POST', self.parameters['token_endpoint'], params=params,
                        headers={'Content-Type': 'application/x-www-form-urlencoded'})
       r.raise_for_status()
       return S_OK(r.json())
     except (self.exceptions.RequestException, ValueError) as e:
-      return S_ERROR("%s: %s" % (e.message, r.text))
+      result = S_ERROR("%s: %s" % (e.message, r.text if r is not None else ''))
+      # Provider is unreachable or broken, that is not a reason to think that tokens are invalid
+      result['Transient'] = r is None or r.status_code >= 500
+      return result
 
   def createState(self):
     """ Generates a state string to be used in authorizations
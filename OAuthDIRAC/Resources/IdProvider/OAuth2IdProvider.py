@@ -2,8 +2,11 @@
 """
 
 import re
+import copy
+import Queue
 import urllib
 import pprint
+import threading
 
 from DIRAC import S_OK, S_ERROR, gLogger
 from DIRAC.Core.Security.X509Chain import X509Chain  # pylint: disable=import-error
@@ -15,9 +18,48 @@ from OAuthDIRAC.FrameworkSystem.Client.OAuthManagerClient import gSessionManager
 
 __RCSID__ = "$Id$"
 
+# Characters that not allowed in the DIRAC user name
+USERNAME_FILTER_RE = re.compile('[^A-Za-z0-9]+')
+# Separator of the groups in "DiracGroups" option
+GROUPS_SPLIT_RE = re.compile(r'\s*,\s*')
+# Sessions that need to remove, processed in background
+gKillQueue = Queue.Queue(maxsize=1000)
+gKillThread = None
+gKillThreadLock = threading.Lock()
+
+
+def killSessionsWorker():
+  """ Remove sessions that put in the queue
+  """
+  while True:
+    session = gKillQueue.get()
+    try:
+      result = gSessionManager.killSession(session)
+      if not result['OK']:
+        gLogger.error('Cannot remove %s session:' % session, result['Message'])
+    except Exception:
+      gLogger.exception('Cannot remove %s session' % session)
+
+
+def startKillSessionsWorker():
+  """ Start thread that remove sessions, if it is not started yet
+  """
+  global gKillThread
+  with gKillThreadLock:
+    if not gKillThread:
+      gKillThread = threading.Thread(target=killSessionsWorker)
+      gKillThread.setDaemon(True)
+      gKillThread.start()
+
 
 class OAuth2IdProvider(IdProvider):
 
+  # Time in a seconds to wait a refresh of the session that already in progress
+  REFRESH_WAIT = 10
+
+  __refreshLock = threading.Lock()
+  __refreshInflight = {}
+
   def __init__(self, parameters=None):
     super(OAuth2IdProvider, self).__init__(parameters)
   
@@ -25,6 +67,10 @@ class OAuth2IdProvider(IdProvider):
     self.log = gLogger.getSubLogger('%s/%s' % (__name__, parameters['ProviderName']))
     self.parameters = parameters
     self.oauth2 = OAuth2(parameters['ProviderName'])
+    # Read regex syntax to get DNs describe dictionary
+    self.dnClaim = parameters.get('Syntax/DNs/claim')
+    dnItemRegex = parameters.get('Syntax/DNs/item')
+    self.dnItemRE = re.compile(dnItemRegex) if dnItemRegex else None
 
   def checkStatus(self, username=None, session=None):
     """ Read ready to work status of identity provider
@@ -36,26 +82,30 @@ class OAuth2IdProvider(IdProvider):
                  - 'Status' with ready to work status[ready, needToAuth]
                  - 'AccessToken' with list of access token
     """
-    sessions = []
+    sessions = set()
     if session:
       result = self.fetchTokensAndUpdateSession(session)
       if result['OK']:
-        sessions += [session]
-      if sessions:
-        result = gSessionManager.getIDForSession(sessions[0])
+        sessions.add(session)
+        result = gSessionManager.getIDForSession(session)
         if not result['OK']:
           return result
         result = Registry.getUsernameForID(result['Value'])
         if not result['OK']:
           return result
+        # Live session is enough to answer, if user sessions not requested
+        if not username:
+          return S_OK({'Status': 'ready', 'UserName': result['Value'], 'Sessions': list(sessions)})
         username = result['Value']
     if username:
       result = gSessionManager.getIdPsCache(Registry.getIDsForUsername(username))
       if not result['OK']:
         return result
+      providerName = self.parameters['ProviderName']
       for idDict in result['Value'].values():
-        if self.parameters['ProviderName'] in idDict:
-          sessions += idDict[self.parameters['ProviderName']].keys()
+        idPSessions = idDict.get(providerName)
+        if idPSessions:
+          sessions.update(idPSessions)
     if not sessions:
       result = self.oauth2.createAuthRequestURL(session)
       if not result['OK']:
@@ -63,7 +113,7 @@ class OAuth2IdProvider(IdProvider):
       result['Value']['Status'] = 'needToAuth'
       return result
     
-    return S_OK({'Status': 'ready', 'UserName': username, 'Sessions': list(set(sessions))})
+    return S_OK({'Status': 'ready', 'UserName': username, 'Sessions': list(sessions)})
 
   def parseAuthResponse(self, response):
     """ Make user info dict:
@@ -77,7 +127,6 @@ class OAuth2IdProvider(IdProvider):
 
         :return: S_OK(dict)/S_ERROR()
     """
-    resDict = {}
     result = self.oauth2.fetchToken(response['code'])
     if not result['OK']:
       return result
@@ -88,15 +137,10 @@ class OAuth2IdProvider(IdProvider):
     result = self.__parseUserProfile(result['Value'])
     if not result['OK']:
       return result
-    userProfile = result['Value']
-
-    for key, value in userProfile.items():
-      resDict[key] = value
-    result = self.__fetchTokens(tokens)
-    if not result['OK']:
-      return result
-    resDict['Tokens'] = result['Value']
-    self.log.debug('Got response dictionary:\n', pprint.pformat(resDict))
+    resDict = result['Value']
+    resDict['Tokens'] = tokens
+    if self.log.shown('DEBUG'):
+      self.log.debug('Got response dictionary:\n', pprint.pformat(resDict))
     return S_OK(resDict)
 
   def fetch(self, session):
@@ -113,22 +157,81 @@ class OAuth2IdProvider(IdProvider):
 
         :param basestring,dict session: session number or dictionary
 
-        :return: S_OK()/S_ERROR()
+        :return: S_OK(dict)/S_ERROR() -- dictionary contain fresh tokens
     """
-    tokens = session
-    if isinstance(session, basestring):
-      result = gSessionManager.getSessionTokens(session)
-      if not result['OK']:
-        return result
-      tokens = result['Value']
-    result = self.__fetchTokens(tokens)
+    result = self.__resolveTokens(session)
+    if not result['OK']:
+      return result
+    result = self.refreshTokens(result['Value'])
     if not result['OK']:
-      kill = gSessionManager.killSession(session)
+      # Keep the session to try to refresh it later, when identity provider will be available
+      if result.get('Transient'):
+        return result
+      kill = self.__killSession(session)
       return result if kill['OK'] else kill
-    return gSessionManager.updateSession(session, result['Value'])
+    tokens = result['Value']
+    result = gSessionManager.updateSession(session, tokens)
+    if not result['OK']:
+      return result
+    return S_OK(tokens)
   
-  def __fetchTokens(self, tokens):
-    """ Fetch tokens
+  def __killSession(self, session):
+    """ Remove session in background, if queue is full remove it right away
+
+        :param basestring,dict session: session number or dictionary
+
+        :return: S_OK()/S_ERROR()
+    """
+    if not isinstance(session, basestring):
+      return S_OK()
+    startKillSessionsWorker()
+    try:
+      gKillQueue.put_nowait(session)
+    except Queue.Full:
+      return gSessionManager.killSession(session)
+    return S_OK()
+
+  def __resolveTokens(self, session):
+    """ Get tokens of session
+
+        :param basestring,dict session: session number or tokens dictionary
+
+        :return: S_OK(dict)/S_ERROR() -- dictionary contain tokens
+    """
+    if isinstance(session, basestring):
+      return gSessionManager.getSessionTokens(session)
+    return S_OK(session)
+
+  def refreshTokens(self, tokens):
+    """ Refresh tokens, session is not updated. Concurrent requests to refresh
+        the same refresh token wait for the result of the first one
+
+        :param dict tokens: tokens
+
+        :return: S_OK(dict)/S_ERROR() -- dictionary contain tokens
+    """
+    key = tokens.get('RefreshToken')
+    if not key:
+      return self.__refreshTokens(tokens)
+    with self.__refreshLock:
+      inflight = self.__refreshInflight.get(key)
+      owner = not inflight
+      if owner:
+        inflight = self.__refreshInflight[key] = {'Event': threading.Event()}
+    if not owner:
+      inflight['Event'].wait(self.REFRESH_WAIT)
+      # Every waiter get own copy of the result to not share changes
+      return copy.deepcopy(inflight.get('Result')) or S_ERROR('Timeout waiting for tokens refresh.')
+    try:
+      inflight['Result'] = self.__refreshTokens(tokens)
+    finally:
+      with self.__refreshLock:
+        del self.__refreshInflight[key]
+      inflight['Event'].set()
+    return copy.deepcopy(inflight['Result'])
+
+  def __refreshTokens(self, tokens):
+    """ Refresh tokens
 
         :param dict tokens: tokens
 
@@ -137,7 +240,10 @@ class OAuth2IdProvider(IdProvider):
     result = self.oauth2.fetchToken(refreshToken=tokens['RefreshToken'])
     if not result['OK']:
       return result
-    return S_OK(self.__parseTokens(result['Value']))
+    freshTokens = self.__parseTokens(result['Value'])
+    # Identity provider may not rotate refresh token, so keep the current one
+    freshTokens['RefreshToken'] = freshTokens['RefreshToken'] or tokens['RefreshToken']
+    return S_OK(freshTokens)
 
   def __parseTokens(self, tokens):
     """ Parse session tokens
@@ -146,12 +252,11 @@ class OAuth2IdProvider(IdProvider):
 
         :return: dict
     """
-    resDict = {}
-    resDict['ExpiresIn'] = tokens.get('expires_in') or 0
-    resDict['TokenType'] = tokens.get('token_type') or 'bearer'
-    resDict['AccessToken'] = tokens.get('access_token')
-    resDict['RefreshToken'] = tokens.get('refresh_token')
-    return resDict
+    # Some providers send the live time of access token as a string
+    return {'ExpiresIn': int(tokens.get('expires_in') or 0),
+            'TokenType': tokens.get('token_type') or 'bearer',
+            'AccessToken': tokens.get('access_token'),
+            'RefreshToken': tokens.get('refresh_token')}
   
   def __parseUserProfile(self, userProfile):
     """ Parse user profile
@@ -164,9 +269,17 @@ class OAuth2IdProvider(IdProvider):
     gname = userProfile.get('given_name')
     fname = userProfile.get('family_name')
     pname = userProfile.get('preferred_username')
-    name = userProfile.get('name') and userProfile['name'].split(' ')
-    resDict['username'] = pname or gname and fname and gname[0] + fname or name and len(name) > 1 and name[0][0] + name[1] or ''
-    resDict['username'] = re.sub('[^A-Za-z0-9]+', '', resDict['username'].lower())[:13]
+    name = userProfile.get('name')
+    name = name.split(' ') if name else []
+    if pname:
+      username = pname
+    elif gname and fname:
+      username = gname[0] + fname
+    elif len(name) > 1:
+      username = name[0][0] + name[1]
+    else:
+      username = ''
+    resDict['username'] = USERNAME_FILTER_RE.sub('', username.lower())[:13]
     self.log.debug('Parse user name:', resDict['username'])
 
     # Collect user info
@@ -182,32 +295,32 @@ class OAuth2IdProvider(IdProvider):
     # Default DIRAC groups
     resDict['UsrOptns']['Groups'] = self.parameters.get('DiracGroups') or []
     if not isinstance(resDict['UsrOptns']['Groups'], list):
-      resDict['UsrOptns']['Groups'] = resDict['UsrOptns']['Groups'].replace(' ','').split(',')
+      resDict['UsrOptns']['Groups'] = filter(None, GROUPS_SPLIT_RE.split(resDict['UsrOptns']['Groups'].strip()))
     self.log.debug('Default for groups:', ', '.join(resDict['UsrOptns']['Groups']))
-    self.log.debug('Response Information:', pprint.pformat(userProfile))
+    if self.log.shown('DEBUG'):
+      self.log.debug('Response Information:', pprint.pformat(userProfile))
 
 
     # FIXME:Lytov: parse DN:VO:Role:ProxyProvider to resDict['UsrOptns'][DNs] = []
 
 
-    # Read regex syntax to get DNs describe dictionary
-    dnClaim = self.parameters.get('Syntax/DNs/claim')
-    dnItemRegex = self.parameters.get('Syntax/DNs/item')
-    if not dnClaim or not dnItemRegex and not resDict['UsrOptns']['Groups']:
-      self.log.warn('No "DiracGroups", no claim with DNs decsribe in Syntax/DNs section found.')
-    elif not userProfile.get(dnClaim) and not resDict['UsrOptns']['Groups']:
-      self.log.warn('No "DiracGroups", no claim "%s" that decsribe DNs found.' % dnClaim)
-    else:
-      claimDNsList = userProfile[dnClaim]
-      if not isinstance(claimDNsList, list):
-        claimDNsList = claimDNsList.split(',')
-      
-      __prog = re.compile(dnItemRegex)
-      for item in claimDNsList:
-        result = __prog.match(item)
-        if result:
-          __parse = result.groupdict()
-          resDict['UsrOptns']['DNs'][__parse['DN']] = __parse
+    if not (self.dnClaim and self.dnItemRE):
+      if not resDict['UsrOptns']['Groups']:
+        self.log.warn('No "DiracGroups", no claim with DNs decsribe in Syntax/DNs section found.')
+      return S_OK(resDict)
+
+    claimDNsList = userProfile.get(self.dnClaim)
+    if not claimDNsList:
+      if not resDict['UsrOptns']['Groups']:
+        self.log.warn('No "DiracGroups", no claim "%s" that decsribe DNs found.' % self.dnClaim)
+      return S_OK(resDict)
+
+    if not isinstance(claimDNsList, list):
+      claimDNsList = claimDNsList.split(',')
+    dnsDict = resDict['UsrOptns']['DNs']
+    for match in filter(None, map(self.dnItemRE.match, claimDNsList)):
+      __parse = match.groupdict()
+      dnsDict[__parse['DN']] = __parse
     return S_OK(resDict)
   
   def getUserProfile(self, session):
@@ -217,27 +330,43 @@ class OAuth2IdProvider(IdProvider):
 
         :return: S_OK(dict)/S_ERROR() -- dictionary contain user profile information
     """
-    tokens = session
-    if isinstance(session, basestring):
-      result = gSessionManager.getSessionTokens(session)
-      if not result['OK']:
-        return result
-      tokens = result['Value']
-    result = self.oauth2.getUserProfile(tokens['AccessToken'])
+    result = self.__resolveTokens(session)
     if not result['OK']:
-      result = self.__fetchTokens(tokens)
-      if result['OK']:
-        tokens = result['Value']
-        result = self.oauth2.getUserProfile(result['Value']['AccessToken'])
+      return result
+    result = self.__getUserProfileWithRetry(result['Value'])
     if not result['OK']:
-      kill = gSessionManager.killSession(session)
+      # Keep the session if identity provider is not available
+      if result.get('Transient'):
+        return result
+      kill = self.__killSession(session)
       return result if kill['OK'] else kill
-    userProfile = result['Value']
+    userProfile, tokens = result['Value']
     result = gSessionManager.updateSession(session, tokens)
     if not result['OK']:
       return result
     return self.__parseUserProfile(userProfile)
 
+  def __getUserProfileWithRetry(self, tokens):
+    """ Get user profile, if access token is not valid try once more with refreshed tokens
+
+        :param dict tokens: tokens
+
+        :return: S_OK(tuple)/S_ERROR() -- tuple contain user profile and tokens that was used
+    """
+    result = self.oauth2.getUserProfile(tokens['AccessToken'])
+    if result['OK']:
+      return S_OK((result['Value'], tokens))
+    if result.get('Transient'):
+      return result
+    result = self.refreshTokens(tokens)
+    if not result['OK']:
+      return result
+    tokens = result['Value']
+    result = self.oauth2.getUserProfile(tokens['AccessToken'])
+    if not result['OK']:
+      return result
+    return S_OK((result['Value'], tokens))
+
   def logOut(self, session):
     """ Revoke tokens
 
@@ -245,10 +374,8 @@ class OAuth2IdProvider(IdProvider):
 
         :return: S_OK()/S_ERROR()
     """
-    tokens = session
-    if isinstance(session, basestring):
-      result = gSessionManager.getSessionTokens(session)
-      if not result['OK']:
-        return result
-      tokens = result['Value']
+    result = self.__resolveTokens(session)
+    if not result['OK']:
+      return result
+    tokens = result['Value']
     return self.oauth2.revokeToken(tokens['AccessToken'], tokens['RefreshToken'])
@@ -1,11 +1,18 @@
 """ ProxyProvider implementation for the proxy generation using OIDC flow
 """
 
+import time
+import Queue
 import pprint
 import datetime
+import threading
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from DIRAC import S_OK, S_ERROR, gLogger
 from DIRAC.Core.Security.X509Chain import X509Chain  # pylint: disable=import-error
+from DIRAC.Core.Utilities.DictCache import DictCache
 from DIRAC.ConfigurationSystem.Client.Helpers import Registry
 from DIRAC.Resources.ProxyProvider.ProxyProvider import ProxyProvider
 from DIRAC.Resources.IdProvider.IdProviderFactory import IdProviderFactory
@@ -18,6 +25,21 @@ __RCSID__ = "$Id$"
 
 class OAuth2ProxyProvider(ProxyProvider):
 
+  # Connect and read timeouts in a seconds of the proxy request
+  REQUEST_TIMEOUT = (3.05, 30)
+  # Time in a seconds to keep ready status of the user
+  STATUS_CACHE_TIME = 60
+  # Time in a seconds to reuse identity provider clients, after that they are created with fresh configuration
+  CLIENTS_CACHE_TIME = 3600
+  # Number of retries of the proxy request on the gateway errors, read timeouts are not retried
+  REQUEST_RETRIES = 1
+  # Time in a seconds to wait a proxy from the sessions, must be longer than two proxy requests
+  # with all retries: 2 * (REQUEST_RETRIES + 1) * (3.05 + 30) ~ 133 seconds, plus tokens refresh
+  PROXY_WAIT = 180
+
+  __statusCache = DictCache()
+  __clientsCache = DictCache()
+
   def __init__(self, parameters=None):
     super(OAuth2ProxyProvider, self).__init__(parameters)
     self.log = gLogger.getSubLogger(__name__)
@@ -27,6 +49,7 @@ class OAuth2ProxyProvider(ProxyProvider):
     self.parameters = parameters
     self.idProvider = None
     self.oauth2 = None
+    self.clientAuth = {}
   
   def checkStatus(self, userDN):
     """ Read ready to work status of proxy provider
@@ -39,16 +62,20 @@ class OAuth2ProxyProvider(ProxyProvider):
                  - 'Status' with ready to work status[ready, needToAuth]
                  - 'AccessTokens' with list of access token
     """
-    result = Registry.getUserNameForDN(userDN)
+    statusDict = self.__statusCache.get((self.parameters['ProviderName'], userDN))
+    if statusDict:
+      return S_OK(statusDict)
+    result = self.__setClients()
     if not result['OK']:
       return result
-    self.userName = result['Value']
-    result = IdProviderFactory().getIdProvider(self.parameters['IdProvider'])
+    result = Registry.getUsernameForDN(userDN)
     if not result['OK']:
       return result
-    self.idProvider = result['Value']
-    self.oauth2 = OAuth2(self.parameters['IdProvider'])
-    return self.idProvider.checkStatus(self.userName)
+    self.userName = result['Value']
+    result = self.idProvider.checkStatus(self.userName)
+    if result['OK'] and result['Value']['Status'] == 'ready':
+      self.__statusCache.add((self.parameters['ProviderName'], userDN), self.STATUS_CACHE_TIME, value=result['Value'])
+    return result
   
   def getProxy(self, userDN):
     """ Generate user proxy with OIDC flow authentication
@@ -66,52 +93,140 @@ class OAuth2ProxyProvider(ProxyProvider):
       return S_ERROR('To get proxy need authentication.', result['Value'])
     elif result['Value']['Status'] != 'ready':
       return S_ERROR('Some unexpexted status.')
+    sessions = result['Value']['Sessions']
+    result = self.__setClients()
+    if not result['OK']:
+      return result
 
-    for session in result['Value']['Sessions']:
-      self.log.verbose('For proxy request use session:', session)
-      # Get tokens
-      result = gSessionManager.getTokensBySession(session)
-      if not result['OK']:
-        return result
-      tokens = result['Value']
-
-      # Get proxy request
-      result = self.__getProxyRequest(tokens['AccessToken'])
-      if not result['OK']:
-        self.log.error(result['Message'])
-        # Refresh tokens
-        tokens['State'] = session
-        result = self.idProvider.fetchTokensAndUpdateSession(tokens)
-        if not result['OK']:
-          self.log.error(result['Message'])
-          continue
-        tokens = result['Value']
-
-        # Try to get proxy request again
-        result = self.__getProxyRequest(tokens['AccessToken'])
-        if not result['OK']:
-          self.log.error(result['Message'])
-          continue
-      
-      self.log.info('Proxy is taken')
-      break
+    # Request proxy with all sessions at once and take the first one returned
+    results = Queue.Queue()
+    stop = threading.Event()
+    for session in sessions:
+      thread = threading.Thread(target=self.__putProxyBySession, args=(session, results, stop))
+      thread.setDaemon(True)
+      thread.start()
+    result = S_ERROR('No sessions found.')
+    deadline = time.time() + self.PROXY_WAIT
+    for _ in sessions:
+      try:
+        result = results.get(timeout=max(deadline - time.time(), 0))
+      except Queue.Empty:
+        result = S_ERROR('Timeout waiting for proxy from %s sessions.' % len(sessions))
+        break
+      if result['OK']:
+        self.log.info('Proxy is taken')
+        break
+      self.log.error(result['Message'])
+    # Other sessions do not need to try anymore
+    stop.set()
 
     if not result['OK']:
+      # Sessions may be dead, so ask identity provider next time
+      self.__statusCache.delete((self.parameters['ProviderName'], userDN))
       return result
     proxyStr = result['Value']
     if not proxyStr:
       return S_ERROR('Returned proxy is empty.')
 
     # Get DN
+    result = self.__getProxyDN(proxyStr)
+    if not result['OK']:
+      return result
+    return S_OK({'proxy': proxyStr, 'DN': result['Value']})
+
+  def __putProxyBySession(self, session, results, stop):
+    """ Get proxy with tokens of session and put result to the queue, that need to run in a thread
+
+        :param basestring session: session number
+        :param Queue.Queue results: queue to put result
+        :param threading.Event stop: event that is set when proxy is not needed anymore
+    """
+    try:
+      result = self.__getProxyBySession(session, stop)
+    except Exception as e:
+      self.log.exception('Cannot get proxy with %s session' % session)
+      result = S_ERROR(str(e))
+    results.put(result)
+
+  def __getProxyBySession(self, session, stop):
+    """ Get proxy with tokens of session, refresh tokens if need
+
+        :param basestring session: session number
+        :param threading.Event stop: event that is set when proxy is not needed anymore
+
+        :return: S_OK(basestring)/S_ERROR()
+    """
+    self.log.verbose('For proxy request use session:', session)
+    # Service refresh tokens if access token will expire soon
+    result = gSessionManager.getFreshSessionTokens(session, int(self.parameters.get('TokenRefreshTime') or 300))
+    if not result['OK']:
+      return result
+    result = self.__getProxyRequest(result['Value']['AccessToken'])
+    if result['OK']:
+      return result
+    self.log.verbose('%s session:' % session, result['Message'])
+
+    # Refresh tokens and try to get proxy again
+    if stop.isSet():
+      return S_ERROR('Proxy is not needed anymore.')
+    result = self.idProvider.fetchTokensAndUpdateSession(session)
+    if not result['OK']:
+      return result
+    if stop.isSet():
+      return S_ERROR('Proxy is not needed anymore.')
+    return self.__getProxyRequest(result['Value']['AccessToken'])
+
+  def __setClients(self):
+    """ Set identity provider and OAuth2 clients, if they are not set yet
+
+        :return: S_OK()/S_ERROR()
+    """
+    if not self.oauth2:
+      result = self.__getClients()
+      if not result['OK']:
+        return result
+      self.idProvider, self.oauth2 = result['Value']
+      self.clientAuth = {'client_id': self.oauth2.parameters['client_id'],
+                         'client_secret': self.oauth2.parameters['client_secret']}
+    return S_OK()
+
+  def __getClients(self):
+    """ Get identity provider and OAuth2 clients, they are shared between provider instances
+        to keep connections to the identity provider alive between requests
+
+        :return: S_OK(tuple)/S_ERROR() -- tuple contain identity provider and OAuth2 client
+    """
+    clients = self.__clientsCache.get(self.parameters['IdProvider'])
+    if not clients:
+      result = IdProviderFactory().getIdProvider(self.parameters['IdProvider'])
+      if not result['OK']:
+        return result
+      clients = (result['Value'], OAuth2(self.parameters['IdProvider']))
+      self.__clientsCache.add(self.parameters['IdProvider'], self.CLIENTS_CACHE_TIME, value=clients)
+    oauth2 = clients[1]
+    if self.parameters['GetProxyEndpoint'] not in oauth2.adapters:
+      # Proxy requests are idempotent, so retry them on the gateway errors
+      oauth2.mount(self.parameters['GetProxyEndpoint'],
+                   HTTPAdapter(pool_connections=10, pool_maxsize=50,
+                               max_retries=Retry(total=self.REQUEST_RETRIES, read=0, backoff_factor=0.2,
+                                                 status_forcelist=[502, 503, 504])))
+    return S_OK(clients)
+
+  def __getProxyDN(self, proxyStr):
+    """ Get DN of the proxy owner
+
+        :param basestring proxyStr: proxy
+
+        :return: S_OK(basestring)/S_ERROR()
+    """
     chain = X509Chain()
     result = chain.loadProxyFromString(proxyStr)
     if not result['OK']:
       return result
-    result = chain.getCredentials()
+    result = chain.getIssuerCert()
     if not result['OK']:
       return result
-    DN = result['Value']['identity']
-    return S_OK({'proxy': proxyStr, 'DN': DN})
+    return result['Value'].getSubjectDN()
 
   def __getProxyRequest(self, accessToken):
     """ Get user proxy from proxy provider
@@ -126,11 +241,11 @@ class OAuth2ProxyProvider(ProxyProvider):
     
     # Get proxy request
     self.log.verbose('Send proxy request to %s' % self.parameters['GetProxyEndpoint'])
-    kwargs['client_id'] = self.oauth2.get('client_id')
-    kwargs['client_secret'] = self.oauth2.get('client_secret')
+    kwargs.update(self.clientAuth)
     try:
-      r = self.oauth2.request('GET', self.parameters['GetProxyEndpoint'], params=kwargs, headers={})
+      r = self.oauth2.request('GET', self.parameters['GetProxyEndpoint'], params=kwargs, headers={},
+                              timeout=self.REQUEST_TIMEOUT)
       r.raise_for_status()
-      return S_OK(r.text)
+      return S_OK(r.content)
     except self.oauth2.exceptions.RequestException as e:
-      return S_ERROR("%s: %s" % (e.message, r.text))
+      return S_ERROR("%s: %s" % (e.message, e.response.text if e.response is not None else ''))
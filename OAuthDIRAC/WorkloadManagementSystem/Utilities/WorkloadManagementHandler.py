@@ -5,6 +5,9 @@ import json
 import time
 import types
 import shutil
+import hashlib
+import datetime
+import threading
 import tempfile
 
 from tornado import web, gen
@@ -21,6 +24,10 @@ from WebAppDIRAC.Lib.WebHandler import WebHandler, asyncGen, WErr, WOK
 
 __RCSID__ = "$Id$"
 
+# Job ID and job object parts of the request path
+JID_RE = re.compile("([0-9]+)?")
+OBJ_RE = re.compile("([a-z]+)?")
+
 
 class WorkloadManagementHandler(WebHandler):
   OVERPATH = True
@@ -42,7 +49,7 @@ class WorkloadManagementHandler(WebHandler):
                 ('ownerGroup', 'OwnerGroup'),
                 ('owner', 'Owner')]
 
-  NUMERICAL = ('jid', 'cpuTime', 'priority')
+  NUMERICAL = frozenset(('jid', 'cpuTime', 'priority'))
 
   FLAGS = [('verified', 'VerifiedFlag'),
            ('retrieved', 'RetrievedFlag'),
@@ -60,6 +67,18 @@ class WorkloadManagementHandler(WebHandler):
            ('heartBeat', 'HeartBeatTime'),
            ('endExecution', 'EndExecTime')]
 
+  # Request arguments that can be used as job selection
+  SELECTION_FIELDS = dict(ATTRIBUTES + FLAGS)
+
+  MAX_JOBS = 1000
+  # Maximum number of jobs of one request that are submitted at the same time
+  MAX_SUBMISSIONS = 8
+
+  __indexesCache = {}
+  __jobsInflight = {}
+  __sbClient = None
+  __sbClientLock = threading.Lock()
+
   def initialize(self):
     super(WorkloadManagementHandler, self).initialize()
     self.loggin = gLogger.getSubLogger(__name__)
@@ -73,7 +92,7 @@ class WorkloadManagementHandler(WebHandler):
             Any job attribute can also be defined as a restriction in a HTTP list form. For instance:
               Site=DIRAC.Site.com&Site=DIRAC.Site2.com&Status=Waiting
             * allOwners - show jobs from all owners instead of just the current user. By default is set to false.
-            * maxJobs - maximum number of jobs to retrieve. By default is set to 100.
+            * maxJobs - maximum number of jobs to retrieve. By default is set to 100, at most 1000.
             * startJob - starting job for the query. By default is set to 0.
           
         GET /jobs/<jid> -- retrieve info about job with id=*jid*
@@ -89,15 +108,19 @@ class WorkloadManagementHandler(WebHandler):
               {Executable: "/bin/echo",
                Arguments: "Hello World",
                Sites: ["DIRAC.Site.com", "DIRAC.Site2.com"]}
+             Several manifests are submitted at once, if some of them fail the response contain
+             identity numbers of submitted jobs and errors of the failed manifests.
 
         DELETE /jobs/<jid> -- kill a job. The user has to have privileges over a job.
           * jid - job identity number
+        DELETE /jobs?jid=<jid>&jid=<jid> -- kill several jobs at once, response contain status for each job.
     """
+    args = self.request.arguments
     optns = self.overpath.strip('/').split('/')
     if len(optns) > 2:
       raise WErr(404, "Wrone way")
-    __jid = re.match("([0-9]+)?", optns[0]).group()
-    __obj = re.match("([a-z]+)?", optns[1]).group() if len(optns) > 1 else None
+    __jid = JID_RE.match(optns[0]).group()
+    __obj = OBJ_RE.match(optns[1]).group() if len(optns) > 1 else None
     self.loggin.info(__jid, '<<<')
     self.loggin.info(__obj, '<<<')
 
@@ -111,6 +134,7 @@ class WorkloadManagementHandler(WebHandler):
           self.log.error(result.msg)
           raise result
         self.finish(result.data)
+        return
 
       # outputsandbox, inputsandbox
       elif __obj in ("outputsandbox", "inputsandbox"):
@@ -124,39 +148,38 @@ class WorkloadManagementHandler(WebHandler):
         cacheTime = 86400
         self.set_header("Expires", datetime.datetime.utcnow() + datetime.timedelta(seconds=cacheTime))
         self.set_header("Cache-Control", "max-age=%d" % cacheTime)
-        self.set_header("ETag", '"%s"' % hashlib.sha1(data).hexdigest)
+        self.set_header("ETag", '"%s"' % hashlib.sha1(data).hexdigest())
         self.set_header("Content-Disposition", 'attachment; filename="%s-%s.tar.gz"' % (__jid, __obj))
         self.finish(data)
+        return
 
       # summary
       elif __obj == 'summary':
         selDict = {}
-        if 'allOwners' not in self.request.arguments:
+        if 'allOwners' not in args:
           selDict[ 'Owner' ] = self.getUserName()
         rpc = RPCClient( "WorkloadManagement/JobMonitoring" )
-        if 'group' not in self.request.arguments:
+        if 'group' not in args:
           group = [ 'Status' ]
         else:
-          group = self.request.arguments[ 'group' ]
+          group = args[ 'group' ]
         result = yield self.threadTask( rpc.getCounters, group, selDict )
         if not result[ 'OK' ]:
           self.log.error( "Could not retrieve job counters", result[ 'Message' ] )
           raise WErr( 500 )
-        data = {}
-        for cDict, count in result[ 'Value' ]:
-          cKey = "|".join( [ cDict[ k ] for k in group ] )
-          data[ cKey ] = count
-        self.finish( data )
+        data = dict(("|".join(cDict[k] for k in group), count) for cDict, count in result['Value'])
+        self.finish(data)
+        return
       
       # history
       elif __obj == 'history':
         condDict = {}
-        if 'allOwners' not in self.request.arguments:
+        if 'allOwners' not in args:
           condDict['Owner'] = self.getUserName()
         timespan = 86400
-        if 'timeSpan' in self.request.arguments:
+        if 'timeSpan' in args:
           try:
-            timespan = int(self.request.arguments['timeSpan'][-1])
+            timespan = int(args['timeSpan'][-1])
           except ValueError:
             raise WErr(400, reason="timeSpan has to be an integer!")
         rpc = ReportsClient()
@@ -166,8 +189,8 @@ class WorkloadManagementHandler(WebHandler):
         if not result['OK']:
           self.log.error(result['Message'])
           raise WErr(500)
-        data = result['Value']
-        self.finish(data)
+        self.finish(result['Value'])
+        return
       
       # invalid
       elif __obj:
@@ -179,25 +202,25 @@ class WorkloadManagementHandler(WebHandler):
       if __jid:
         selDict = {'JobID': int(__jid)}
       else:
-        selDict = {}
-        for convList in (self.ATTRIBUTES, self.FLAGS):
-          for attrPair in convList:
-            jAtt = attrPair[0]
-            if jAtt in self.request.arguments:
-              selDict[attrPair[1]] = self.request.arguments[jAtt]
-        if 'allOwners' not in self.request.arguments:
+        selDict = dict((self.SELECTION_FIELDS[jAtt], args[jAtt])
+                       for jAtt in set(args).intersection(self.SELECTION_FIELDS))
+        if 'allOwners' not in args:
           selDict['Owner'] = self.getUserName()
-        if 'startJob' in self.request.arguments:
-          try:
-            startJob = max(startJob, int(self.request.arguments['startJob'][-1]))
-          except ValueError:
-            raise WErr(400, reason="startJob has to be an integer")
-        if 'maxJobs' in self.request.arguments:
-          try:
-            maxJobs = max(maxJobs, int(self.request.arguments['maxJobs'][-1]))
-          except ValueError:
-            raise WErr(400, reason="maxJobs has to be an integer")
-      result = yield self.threadTask(self._getJobs, selDict, startJob, maxJobs)
+        try:
+          startJob = int(args.get('startJob', [startJob])[-1])
+          maxJobs = min(int(args.get('maxJobs', [maxJobs])[-1]), self.MAX_JOBS)
+        except ValueError:
+          raise WErr(400, reason="startJob and maxJobs have to be integers")
+        if startJob < 0 or maxJobs < 1:
+          raise WErr(400, reason="startJob has to be non-negative and maxJobs positive")
+      # Identical requests that came at the same time wait for the same result
+      key = (self.getUserName(), self.getUserGroup(), repr(sorted(selDict.items())), startJob, maxJobs)
+      future = self.__jobsInflight.get(key)
+      if not future:
+        future = self.threadTask(self._getJobs, selDict, startJob, maxJobs)
+        self.__jobsInflight[key] = future
+        future.add_done_callback(lambda f: self.__jobsInflight.pop(key, None))
+      result = yield future
       if not result.ok:
         raise result
       data = result.data
@@ -213,10 +236,10 @@ class WorkloadManagementHandler(WebHandler):
       if __jid:
         self.send_error(404)
         return
-      if 'manifest' not in self.request.arguments:
+      if 'manifest' not in args:
         raise WErr(400, "No manifest")
       manifests = []
-      for manifest in self.request.arguments['manifest']:
+      for manifest in args['manifest']:
         try:
           manifest = json.loads(manifest)
         except ValueError:
@@ -241,37 +264,63 @@ class WorkloadManagementHandler(WebHandler):
           isb.append(sb)
           manifest['InputSandbox'] = isb
 
-      # Send jobs
+      # Render all job descriptions before submission to not submit only a part of the jobs
+      result = yield self.threadTask(self._renderJDLs, manifests)
+      if not result.ok:
+        raise result
+      jdls = result.data
+
+      # Send jobs concurrently, but not too many at once to leave threads for other requests
+      results = []
+      for i in range(0, len(jdls), self.MAX_SUBMISSIONS):
+        results += yield [self.threadTask(self._submitJob, jdl) for jdl in jdls[i:i + self.MAX_SUBMISSIONS]]
       jids = []
-      rpc = RPCClient('WorkloadManagement/JobManager')
-      for manifest in manifests:
-        jdl = dumpCFGAsJDL(CFG.CFG().loadFromDict(manifest))
-        result = yield self.threadTask(rpc.submitJob, str(jdl))
-        if not result['OK']:
-          self.log.error("Could not submit job: %s" % result['Message'])
-          raise WErr(500, result['Message'])
-        data = result['Value']
-        if type(data) == types.ListType:
-          jids.extend(data)
-        else:
-          jids.append(data)
+      errors = []
+      for i, result in enumerate(results):
+        if not result.ok:
+          self.log.error("Could not submit job: %s" % result.msg)
+          errors.append({'manifest': i, 'message': result.msg})
+          continue
+        jids.extend(result.data)
+      if errors and not jids:
+        raise WErr(500, errors[0]['message'])
       self.log.info("Got jids %s" % jids)
+      if errors:
+        # Report submitted jobs to not resubmit them again
+        self.set_status(500)
+        self.finish({'jids': jids, 'errors': errors})
+        return
       self.finish({'jids': jids})
 
     # DELETE
     elif self.request.method == 'DELETE':
-      if not __jid:
+      jids = ([__jid] if __jid else []) + args.get('jid', [])
+      if not jids:
         self.send_error(404)
         return
       try:
-        __jid = int(__jid)
+        jids = [int(jid) for jid in jids]
       except ValueError:
         raise WErr(400, "Invalid jid")
       rpc = RPCClient('WorkloadManagement/JobManager')
-      if 'killonly' in self.request.arguments and self.request.arguments['killonly']:
-        result = yield self.threadTask(rpc.killJob, [__jid])
+      if args.get('killonly'):
+        result = yield self.threadTask(rpc.killJob, jids)
       else:
-        result = yield self.threadTask(rpc.deleteJob, [__jid])
+        result = yield self.threadTask(rpc.deleteJob, jids)
+
+      # Several jobs, report status of each job
+      if len(jids) > 1:
+        statusDict = dict((jid, 'done') for jid in jids)
+        if not result['OK']:
+          if not any(key in result for key in ('NonauthorizedJobIDs', 'InvalidJobIDs', 'FailedJobIDs')):
+            raise WErr(500, result['Message'])
+          for key, status in (('NonauthorizedJobIDs', 'not authorized'), ('InvalidJobIDs', 'invalid'),
+                              ('FailedJobIDs', 'failed')):
+            for jid in result.get(key, []):
+              statusDict[jid] = status
+        self.finish({'jids': statusDict})
+        return
+
       if not result['OK']:
         if 'NonauthorizedJobIDs' in result:
           # Not authorized
@@ -282,19 +331,22 @@ class WorkloadManagementHandler(WebHandler):
         if 'FailedJobIDs' in result:
           # "Could not delete JID"
           raise WErr(500, "Could not delete")
-      self.finish({'jid': __jid})
+      self.finish({'jid': jids[0]})
 
   def __findIndexes(self, paramNames):
+    paramNames = tuple(paramNames)
+    # Parameter names is the same for all requests, so calculate indexes once
+    if paramNames in self.__indexesCache:
+      return self.__indexesCache[paramNames]
+    positions = dict((name, iP) for iP, name in enumerate(paramNames))
     indexes = {}
     for k, convList in (('attrs', self.ATTRIBUTES), ('flags', self.FLAGS), ('times', self.TIMES)):
       indexes[k] = {}
       for attrPair in convList:
-        try:
-          iP = paramNames.index(attrPair[1])
-        except ValueError:
-          # Not found
-          pass
-        indexes[k][attrPair[0]] = iP
+        # Skip parameters that not found
+        if attrPair[1] in positions:
+          indexes[k][attrPair[0]] = positions[attrPair[1]]
+    self.__indexesCache[paramNames] = indexes
     return indexes
 
 
@@ -309,43 +361,80 @@ class WorkloadManagementHandler(WebHandler):
     if totalRecords == 0:
       return WOK(retData)
     indexes = self.__findIndexes(origData['ParameterNames'])
+    # Prepare conversion lists once for all records
+    numerical = self.NUMERICAL
+    attrsItems = indexes['attrs'].items()
+    flagsItems = indexes['flags'].items()
+    timesItems = indexes['times'].items()
     records = origData['Records']
-    for record in records:
-      job = {}
-      for param in indexes['attrs']:
-        job[param] = record[indexes['attrs'][param]]
-        if param in self.NUMERICAL:
-          job[param] = int(float(job[param]))
-      for k in ('flags', 'times'):
-        job[k] = {}
-        for field in indexes[k]:
-          value = record[indexes[k][field]]
-          if value.lower() == "none":
-            continue
-          if k == 'flags':
-            job[k][field] = value.lower() == 'true'
-          else:
-            job[k][field] = value
-      retData['jobs'].append(job)
+    jobs = [None] * len(records)
+    for i, record in enumerate(records):
+      job = dict((param, int(float(record[iP])) if param in numerical else record[iP]) for param, iP in attrsItems)
+      flags = ((field, record[iP].lower()) for field, iP in flagsItems)
+      job['flags'] = dict((field, value == 'true') for field, value in flags if value != "none")
+      job['times'] = dict((field, record[iP]) for field, iP in timesItems if record[iP].lower() != "none")
+      jobs[i] = job
+    retData['jobs'] = jobs
     return WOK(retData)
 
+  def _renderJDLs(self, manifests):
+    jdls = []
+    for manifest in manifests:
+      try:
+        jdls.append(str(dumpCFGAsJDL(CFG.CFG().loadFromDict(manifest))))
+      except Exception as e:
+        return WErr(400, "Invalid manifest: %s" % e)
+    return WOK(jdls)
+
+  def _submitJob(self, jdl):
+    result = RPCClient('WorkloadManagement/JobManager').submitJob(jdl)
+    if not result['OK']:
+      return WErr(500, result['Message'])
+    if type(result['Value']) == types.ListType:
+      return WOK(result['Value'])
+    return WOK([result['Value']])
+
   def uploadSandbox(self, fileData):
     with TmpDir() as tmpDir:
       fileList = []
+      fileNames = set()
       for fName in fileData:
         for entry in fileData[fName]:
-          tmpFile = os.path.join(tmpDir, entry.filename)
-          if tmpFile not in fileList:
-            fileList.append(tmpFile)
-          dfd = open(tmpFile, "w")
-          dfd.write(entry.body)
-          dfd.close()
-      sbClient = SandboxStoreClient()
-      result = sbClient.uploadFilesAsSandbox(fileList)
+          # Keep only name of the file to not write outside of the directory
+          name = os.path.basename(entry.filename)
+          if not name:
+            return WErr(400, "Invalid file name: %s" % entry.filename)
+          # Add counter to the name of the files with the same name
+          base, ext = os.path.splitext(name)
+          count = 0
+          while name in fileNames:
+            count += 1
+            name = "%s_%d%s" % (base, count, ext)
+          if count:
+            self.log.warn("%s file is renamed to %s, the name is already used" % (entry.filename, name))
+          fileNames.add(name)
+          tmpFile = os.path.join(tmpDir, name)
+          fileList.append(tmpFile)
+          with open(tmpFile, "wb") as dfd:
+            dfd.write(entry.body)
+      result = self._getSandboxClient().uploadFilesAsSandbox(fileList)
       if not result['OK']:
         return WErr(500, result['Message'])
       return WOK(result['Value'])
 
+  @classmethod
+  def _getSandboxClient(cls):
+    """ Get sandbox store client shared by all requests, it creates RPC and transfer
+        clients per call, so the credentials of the current request are used
+
+        :return: SandboxStoreClient
+    """
+    if not cls.__sbClient:
+      with cls.__sbClientLock:
+        if not cls.__sbClient:
+          cls.__sbClient = SandboxStoreClient()
+    return cls.__sbClient
+
   def _getJobManifest( self, jid ):
     result = RPCClient( "WorkloadManagement/JobMonitoring" ).getJobJDL( int( jid  ) )
     if not result[ 'OK' ]:
@@ -357,7 +446,7 @@ class WorkloadManagementHandler(WebHandler):
     jobData = {}
     stack = [ ( cfg, jobData ) ]
     while stack:
-      cfg, level = stack.pop( 0 )
+      cfg, level = stack.pop()
       for op in cfg.listOptions():
         val = List.fromChar( cfg[ op ] )
         if len( val ) == 1:
@@ -374,7 +463,7 @@ class WorkloadManagementHandler(WebHandler):
         objName = "Output"
       else:
         objName = "Input"
-      result = SandboxStoreClient().downloadSandboxForJob( int( jid ), objName, tmpDir, inMemory = True )
+      result = self._getSandboxClient().downloadSandboxForJob( int( jid ), objName, tmpDir, inMemory = True )
       if not result[ 'OK' ]:
         msg = result[ 'Message' ]
         if msg.find( "No %s sandbox" % objName ) == 0:
@@ -388,19 +477,20 @@ class TmpDir( object ):
   def __enter__( self ):
     return self.get()
   def __exit__( self, *exc_info ):
+    if not self.__tmpDir:
+      return
     try:
-      shutil.rmtree( self.__tmpDir )
-      self.__tmpDir = False
-    except:
-      pass
+      shutil.rmtree( self.__tmpDir, onerror = self.__onRemoveError )
+    except OSError as e:
+      gLogger.warn( "Cannot remove temporary directory %s:" % self.__tmpDir, repr( e ) )
+    self.__tmpDir = False
+  @staticmethod
+  def __onRemoveError( func, path, exc_info ):
+    """ Make path writable and try to remove it again """
+    os.chmod( path, 0o700 )
+    func( path )
   def get( self ):
     if not self.__tmpDir:
-      base = os.path.join( "/tmp" )
-      if not os.path.isdir( base ):
-        try:
-          os.makedirs( base )
-        except Exception, e:
-          gLogger.exception( "Cannot create work dir %s: %s" % ( base, e) )
-          raise
-      self.__tmpDir = tempfile.mkdtemp( dir = base )
+      # Use system temporary directory, TMPDIR can point it to the tmpfs
+      self.__tmpDir = tempfile.mkdtemp()
     return self.__tmpDir
\ No newline at end of file